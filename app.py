@@ -1,11 +1,21 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, request, jsonify, g
 from flask_cors import CORS
-import sqlite3
+import apsw
+import msgspec
+import orjson
 import os
+import queue
+import threading
+import atexit
+import logging
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 from datetime import datetime
 
-app = Flask(__name__)
-CORS(app)
+bp = Blueprint('shop', __name__)
+# Cùng logger với app.logger (Flask đặt tên logger theo import name), dùng được cả ở writer thread
+logger = logging.getLogger(__name__)
 
 # Lưu database ở thư mục cố định
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -15,8 +25,8 @@ DB_NAME = DB_PATH
 # --- Init database ---
 def init_db():
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.executescript('''
+        conn = connect_db()
+        conn.execute('''
                 CREATE TABLE IF NOT EXISTS products (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     name TEXT NOT NULL,
@@ -45,25 +55,321 @@ def init_db():
                     FOREIGN KEY(order_id) REFERENCES orders(id),
                     FOREIGN KEY(product_id) REFERENCES products(id)
                 );
-            ''')
+                CREATE INDEX IF NOT EXISTS idx_od_order ON order_details(order_id);
+                CREATE INDEX IF NOT EXISTS idx_od_product ON order_details(product_id);
+                CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders(customer_id);
+                -- Phiên bản dữ liệu, tăng sau mỗi lô ghi; dùng làm khóa cache và ETag
+                CREATE TABLE IF NOT EXISTS data_version (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    version INTEGER NOT NULL
+                );
+                -- Bắt đầu từ một số ngẫu nhiên (48 bit) riêng cho mỗi DB, để ETag của DB cũ
+                -- không trùng với dữ liệu của DB được tạo lại
+                INSERT OR IGNORE INTO data_version (id, version) VALUES (1, random() & 281474976710655);
+        ''')
+        migrate_db(conn)
+        conn.close()
         print("✅ Database initialized successfully.")
-    except Exception as e:
-        print("❌ Error during DB initialization:", e)
+    except Exception:
+        logger.exception("Error during DB initialization")
+
+# Phiên bản schema lưu trong PRAGMA user_version; mỗi bước chuyển đổi chỉ chạy một lần
+def migrate_db(conn):
+    with transaction(conn):
+        # Kiểm tra trong giao dịch ghi, nên nhiều process khởi động cùng lúc cũng chỉ chạy một lần
+        version = conn.execute('PRAGMA user_version').get
+        if version < 1:
+            # orders.total do trigger tính lại từ order_details (dùng index idx_od_order),
+            # ứng dụng không ghi total nữa. Tính lại bằng SUM thay vì cộng/trừ dần
+            # để sai số số thực không bị tích lũy
+            conn.execute('''
+                DROP TRIGGER IF EXISTS trg_od_ai;
+                DROP TRIGGER IF EXISTS trg_od_ad;
+                DROP TRIGGER IF EXISTS trg_od_au;
+                CREATE TRIGGER trg_od_ai AFTER INSERT ON order_details BEGIN
+                    UPDATE orders
+                    SET total = (SELECT COALESCE(SUM(quantity * price), 0) FROM order_details WHERE order_id = NEW.order_id)
+                    WHERE id = NEW.order_id;
+                END;
+                CREATE TRIGGER trg_od_ad AFTER DELETE ON order_details BEGIN
+                    UPDATE orders
+                    SET total = (SELECT COALESCE(SUM(quantity * price), 0) FROM order_details WHERE order_id = OLD.order_id)
+                    WHERE id = OLD.order_id;
+                END;
+                CREATE TRIGGER trg_od_au AFTER UPDATE OF order_id, quantity, price ON order_details BEGIN
+                    UPDATE orders
+                    SET total = (SELECT COALESCE(SUM(quantity * price), 0) FROM order_details WHERE order_id = OLD.order_id)
+                    WHERE id = OLD.order_id;
+                    UPDATE orders
+                    SET total = (SELECT COALESCE(SUM(quantity * price), 0) FROM order_details WHERE order_id = NEW.order_id)
+                    WHERE id = NEW.order_id AND NEW.order_id IS NOT OLD.order_id;
+                END;
+                -- Đồng bộ total của các đơn hàng tạo trước khi có trigger
+                UPDATE orders
+                SET total = (SELECT COALESCE(SUM(quantity * price), 0) FROM order_details WHERE order_id = orders.id);
+                -- total có thể đã đổi, tăng phiên bản để cache và ETag cũ không còn khớp
+                UPDATE data_version SET version = version + 1;
+                PRAGMA user_version = 1;
+            ''')
+
+# --- Câu lệnh SQL dùng chung ---
+# apsw cache các câu lệnh đã prepare theo đúng chuỗi SQL trên mỗi kết nối,
+# nên các câu lệnh dùng nhiều nơi được khai báo một lần ở đây
+SQL_CUSTOMER_EXISTS = 'SELECT id FROM customers WHERE id = ?'
+SQL_ORDER_EXISTS = 'SELECT id FROM orders WHERE id = ?'
+SQL_INSERT_ORDER = 'INSERT INTO orders (customer_id, order_date, total) VALUES (?, ?, 0)'
+SQL_INSERT_ORDER_DETAIL = 'INSERT INTO order_details (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)'
+SQL_DELETE_ORDER_DETAILS = 'DELETE FROM order_details WHERE order_id = ?'
 
 # --- Helper ---
 def connect_db():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    # apsw luôn ở chế độ autocommit, giao dịch được mở tường minh bằng transaction().
+    # Các hàng trả về là tuple, lấy cột theo vị trí
+    conn = apsw.Connection(DB_NAME, statementcachesize=256)
+    conn.set_busy_timeout(5000)
+    # Cấu hình một lần cho mỗi kết nối: WAL giúp ghi tuần tự và cho phép đọc song song.
+    # fetchall() để chạy hết các PRAGMA (apsw dừng ở hàng kết quả đầu tiên)
+    conn.execute('''
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -65536;
+        PRAGMA mmap_size = 268435456;
+        PRAGMA foreign_keys = ON;
+    ''').fetchall()
     return conn
 
-# Thay thế before_first_request bằng câu lệnh thực thi khi khởi động
-with app.app_context():
-    if not os.path.exists(DB_NAME):
-        init_db()
-        print("Database created for the first time")
+# --- Connection pool: một kết nối ghi + nhiều kết nối đọc ---
+# Với WAL, các kết nối đọc không bị chặn bởi kết nối ghi.
+# Chạy bằng gunicorn thì post_fork (gunicorn.conf.py) đặt lại bằng số thread của worker,
+# để mọi thread đều có sẵn một kết nối đọc
+READER_POOL_SIZE = 2 * (os.cpu_count() or 1)
+# Kết nối đọc dùng chung page cache của hệ điều hành qua mmap, nên chỉ cần cache riêng nhỏ
+READER_CACHE_SIZE = -8192
+
+_pool_lock = threading.Lock()
+_writer_lock = threading.Lock()
+_writer = None
+_readers = None
+
+def _init_pool():
+    # Mở kết nối ở lần dùng đầu tiên
+    global _writer, _readers
+    with _pool_lock:
+        if _writer is None:
+            readers = queue.Queue()
+            for _ in range(READER_POOL_SIZE):
+                conn = connect_db()
+                conn.execute('PRAGMA query_only = ON')
+                conn.execute(f'PRAGMA cache_size = {READER_CACHE_SIZE}')
+                readers.put(conn)
+            _readers = readers
+            _writer = connect_db()
+
+@contextmanager
+def reader():
+    if _readers is None:
+        _init_pool()
+    conn = _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
+
+@contextmanager
+def writer():
+    if _writer is None:
+        _init_pool()
+    # Chỉ một thread được dùng kết nối ghi tại một thời điểm
+    with _writer_lock:
+        try:
+            yield _writer
+        finally:
+            # Không để lại giao dịch dở dang cho request sau
+            if _writer.in_transaction:
+                _writer.execute('ROLLBACK')
+
+def with_reader(view):
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        with reader() as conn:
+            g.conn = conn
+            return view(*args, **kwargs)
+    return wrapped
+
+def row_keys(cursor):
+    # Tên cột của câu SELECT; None nếu không có hàng nào (apsw đã chạy xong câu lệnh)
+    try:
+        return [column[0] for column in cursor.description]
+    except apsw.ExecutionCompleteError:
+        return None
+
+def rows_json(cursor):
+    # Serialize thẳng từ cursor bằng orjson, bỏ qua bước dict(row) + jsonify
+    keys = row_keys(cursor)
+    if keys is None:
+        return b'[]'
+    return orjson.dumps([dict(zip(keys, row)) for row in cursor])
+
+def row_dict(cursor):
+    # Hàng đầu tiên dưới dạng dict, hoặc None nếu không có.
+    # Đọc hết kết quả để câu lệnh kết thúc, không giữ snapshot đọc trên kết nối
+    keys = row_keys(cursor)
+    if keys is None:
+        return None
+    return dict(zip(keys, cursor.fetchall()[0]))
+
+# --- Cache cho các request GET ---
+# Kết quả JSON được cache theo phiên bản dữ liệu (bảng data_version, tăng sau mỗi lô ghi).
+# Phiên bản nằm trong DB nên đúng cho cả nhiều worker process; nó cũng được trả về làm ETag
+def data_version(conn):
+    return conn.execute('SELECT version FROM data_version').get
+
+def versioned_response(version, build):
+    # build() trả về bytes JSON, hoặc None nếu không tìm thấy.
+    # Gọi build() trước khi so ETag để tài nguyên không tồn tại luôn trả 404, không phải 304
+    # (build() có lru_cache nên nhánh 304 vẫn rẻ)
+    body = build()
+    if body is None:
+        return None
+    etag = str(version)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    return response
+
+@contextmanager
+def transaction(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+def find_missing_product(conn, product_ids):
+    # Kiểm tra tất cả sản phẩm bằng một câu truy vấn, trả về ID đầu tiên không tồn tại
+    if not product_ids:
+        return None
+    cursor = conn.execute(
+        'SELECT id FROM products WHERE id IN ({})'.format(','.join('?' * len(product_ids))),
+        product_ids
+    )
+    found = {row[0] for row in cursor}
+    for product_id in product_ids:
+        if product_id not in found:
+            return product_id
+    return None
+
+# --- Schema cho dữ liệu gửi lên ---
+# msgspec parse và kiểm tra kiểu JSON trong một lần duyệt, thay cho các kiểm tra 'x' in data
+class CustomerReq(msgspec.Struct):
+    name: str
+    phone: str
+
+class OrderLine(msgspec.Struct):
+    product_id: int
+    quantity: int
+    price: float
+
+class OrderReq(msgspec.Struct):
+    customer_id: int
+    products: list[OrderLine]
+
+class OrderUpdateReq(msgspec.Struct):
+    customer_id: int | msgspec.UnsetType = msgspec.UNSET
+    products: list[OrderLine] | msgspec.UnsetType = msgspec.UNSET
+
+customer_decoder = msgspec.json.Decoder(CustomerReq)
+order_decoder = msgspec.json.Decoder(OrderReq)
+order_update_decoder = msgspec.json.Decoder(OrderUpdateReq)
+
+# --- Writer thread: gom các thao tác ghi theo lô ---
+# Mọi thao tác ghi được đẩy vào hàng đợi; một thread duy nhất lấy tối đa WRITE_BATCH_SIZE
+# thao tác đang chờ sẵn và ghi chúng trong một giao dịch, nên nhiều request dùng chung
+# một lần COMMIT/fsync. Không chờ thêm thao tác mới: khi tải cao, các thao tác tự dồn lại
+# trong lúc lô trước đang COMMIT, còn khi vắng thì thao tác được ghi ngay
+WRITE_BATCH_SIZE = 100
+
+class ApiError(Exception):
+    # Lỗi nghiệp vụ trả về cho client (404, 400...) từ bên trong một thao tác ghi
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+_write_jobs = queue.Queue()
+_write_thread_lock = threading.Lock()
+_write_thread = None
+
+def _write_batch(batch):
+    results = []
+    try:
+        with writer() as conn:
+            with transaction(conn):
+                for job, future in batch:
+                    # Mỗi thao tác có savepoint riêng để một thao tác lỗi không kéo cả lô rollback
+                    conn.execute('SAVEPOINT write_job')
+                    try:
+                        results.append((future, job(conn), None))
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO write_job')
+                        results.append((future, None, e))
+                    conn.execute('RELEASE write_job')
+                # Tăng phiên bản dữ liệu trong cùng giao dịch để cache ở mọi worker biết mà bỏ qua
+                if any(error is None for _, _, error in results):
+                    conn.execute('UPDATE data_version SET version = version + 1')
+    except Exception as e:
+        for _, future in batch:
+            future.set_exception(e)
+        return
+    # Chỉ báo kết quả sau khi đã COMMIT
+    for future, result, error in results:
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+def _writer_loop():
+    while True:
+        batch = [_write_jobs.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_jobs.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write_batch(batch)
+        except Exception:
+            logger.exception("Error writing batch")
+        finally:
+            for _ in batch:
+                _write_jobs.task_done()
+
+def submit_write(job):
+    # job(conn) chạy trên writer thread; trả về Future chứa kết quả sau khi COMMIT
+    global _write_thread
+    if _write_thread is None:
+        with _write_thread_lock:
+            if _write_thread is None:
+                thread = threading.Thread(target=_writer_loop, name='db-writer', daemon=True)
+                thread.start()
+                _write_thread = thread
+    future = Future()
+    _write_jobs.put((job, future))
+    return future
+
+def run_write(job):
+    # Chờ thao tác ghi được COMMIT rồi trả về kết quả (hoặc raise lỗi của nó)
+    return submit_write(job).result()
+
+# Khi tắt server, chờ ghi hết các thao tác còn trong hàng đợi
+atexit.register(_write_jobs.join)
 
 # --- Home ---
-@app.route('/')
+@bp.route('/')
 def home():
     return jsonify({
         "message": "Welcome to Shop API",
@@ -77,436 +383,445 @@ def home():
     })
 
 # --- Init sample data (RENAMED to be more explicit that it resets data) ---
-@app.route('/init-sample-data')
+@bp.route('/init-sample-data')
 def init_sample_data():
+    products = [
+        ("iPhone 14 Pro Max", 27990000, 
+         "https://th.bing.com/th/id/OIP.HlFVZumCmO9aSI_w5x7tIgHaEK?rs=1&pid=ImgDetMain", 
+         "iPhone 14 Pro Max 128GB - Sang trọng, cao cấp"),
+        ("Samsung Galaxy S23 Ultra", 23990000, 
+         "https://cdn.tgdd.vn/Products/Images/42/249948/samsung-galaxy-s23-ultra-thumb-xanh-600x600.jpg",
+         "Samsung Galaxy S23 Ultra - Siêu phẩm Galaxy với bút S-Pen"),
+        ("Xiaomi 13 Pro", 19990000,
+         "https://cdn.tgdd.vn/Products/Images/42/267984/xiaomi-13-pro-thumb-1-600x600.jpg",
+         "Xiaomi 13 Pro - Camera Leica chuyên nghiệp")
+    ]
+
+    def write(conn):
+        # CLEAR WARNING: This deletes all existing data
+        # Xóa và thêm dữ liệu mẫu trong cùng một giao dịch (không dùng executescript
+        # vì nó tự COMMIT giao dịch đang mở)
+        for table in ('order_details', 'orders', 'customers', 'products'):
+            conn.execute(f'DELETE FROM {table}')
+        conn.executemany(
+            'INSERT INTO products (name, price, image, description) VALUES (?, ?, ?, ?)',
+            products
+        )
+
     try:
-        with connect_db() as conn:
-            # CLEAR WARNING: This deletes all existing data
-            conn.executescript('''
-                DELETE FROM order_details;
-                DELETE FROM orders;
-                DELETE FROM customers;
-                DELETE FROM products;
-            ''')
-            products = [
-                ("iPhone 14 Pro Max", 27990000, 
-                 "https://th.bing.com/th/id/OIP.HlFVZumCmO9aSI_w5x7tIgHaEK?rs=1&pid=ImgDetMain", 
-                 "iPhone 14 Pro Max 128GB - Sang trọng, cao cấp"),
-                ("Samsung Galaxy S23 Ultra", 23990000, 
-                 "https://cdn.tgdd.vn/Products/Images/42/249948/samsung-galaxy-s23-ultra-thumb-xanh-600x600.jpg",
-                 "Samsung Galaxy S23 Ultra - Siêu phẩm Galaxy với bút S-Pen"),
-                ("Xiaomi 13 Pro", 19990000,
-                 "https://cdn.tgdd.vn/Products/Images/42/267984/xiaomi-13-pro-thumb-1-600x600.jpg",
-                 "Xiaomi 13 Pro - Camera Leica chuyên nghiệp")
-            ]
-            conn.executemany(
-                'INSERT INTO products (name, price, image, description) VALUES (?, ?, ?, ?)',
-                products
-            )
+        run_write(write)
         return jsonify({"message": "Sample data initialized", "count": len(products), 
                        "warning": "All existing data was deleted"})
     except Exception as e:
-        print("❌ Error initializing sample data:", e)
+        logger.exception("Error initializing sample data")
         return jsonify({"error": str(e)}), 500
 
 # --- GET all products ---
-@app.route('/products', methods=['GET'])
+# Các hàm cache bên dưới dùng kết nối đọc của request hiện tại (g.conn)
+@lru_cache(maxsize=2)
+def _products_json(version):
+    cursor = g.conn.execute('SELECT id, name, price, image, description FROM products')
+    return rows_json(cursor)
+
+@bp.route('/products', methods=['GET'])
+@with_reader
 def get_products():
     try:
-        with connect_db() as conn:
-            cursor = conn.execute('SELECT * FROM products')
-            rows = cursor.fetchall()
-            products = [dict(row) for row in rows]
-        return jsonify(products)
+        version = data_version(g.conn)
+        return versioned_response(version, lambda: _products_json(version))
     except Exception as e:
-        print("❌ Error in /products:", e)
+        logger.exception("Error in /products")
         return jsonify({"error": str(e)}), 500
 
 # --- GET a specific product ---
-@app.route('/products/<int:id>', methods=['GET'])
+@bp.route('/products/<int:id>', methods=['GET'])
+@with_reader
 def get_product(id):
     try:
-        with connect_db() as conn:
-            cursor = conn.execute('SELECT * FROM products WHERE id = ?', (id,))
-            product = cursor.fetchone()
-            if product is None:
-                return jsonify({"error": "Product not found"}), 404
-        return jsonify(dict(product))
+        conn = g.conn
+        cursor = conn.execute('SELECT id, name, price, image, description FROM products WHERE id = ?', (id,))
+        product = row_dict(cursor)
+        if product is None:
+            return jsonify({"error": "Product not found"}), 404
+        return jsonify(product)
     except Exception as e:
-        print("❌ Error in GET /products/<id>:", e)
+        logger.exception("Error in GET /products/<id>")
         return jsonify({"error": str(e)}), 500
 
 # --- POST create product ---
-@app.route('/products', methods=['POST'])
+@bp.route('/products', methods=['POST'])
 def create_product():
     try:
         data = request.get_json()
-        with connect_db() as conn:
-            cursor = conn.execute('''
+        params = (data['name'], data['price'], data['image'], data['description'])
+        
+        def write(conn):
+            conn.execute('''
                 INSERT INTO products (name, price, image, description)
                 VALUES (?, ?, ?, ?)
-            ''', (data['name'], data['price'], data['image'], data['description']))
-            product_id = cursor.lastrowid
+            ''', params)
+            return conn.last_insert_rowid()
+        
+        product_id = run_write(write)
         return jsonify({"message": "Product created", "id": product_id}), 201
     except Exception as e:
-        print("❌ Error in POST /products:", e)
+        logger.exception("Error in POST /products")
         return jsonify({"error": str(e)}), 500
 
 # --- PUT update product ---
-@app.route('/products/<int:id>', methods=['PUT'])
+@bp.route('/products/<int:id>', methods=['PUT'])
 def update_product(id):
     try:
         data = request.get_json()
-        with connect_db() as conn:
-            cursor = conn.execute('''
+        params = (data['name'], data['price'], data['image'], data['description'], id)
+        
+        def write(conn):
+            conn.execute('''
                 UPDATE products
                 SET name = ?, price = ?, image = ?, description = ?
                 WHERE id = ?
-            ''', (data['name'], data['price'], data['image'], data['description'], id))
-            if cursor.rowcount == 0:
-                return jsonify({"error": "Product not found"}), 404
+            ''', params)
+            return conn.changes()
+        
+        updated = run_write(write)
+        if updated == 0:
+            return jsonify({"error": "Product not found"}), 404
         return jsonify({"message": "Product updated"})
     except Exception as e:
-        print("❌ Error in PUT /products:", e)
+        logger.exception("Error in PUT /products")
         return jsonify({"error": str(e)}), 500
 
 # --- DELETE product ---
-@app.route('/products/<int:id>', methods=['DELETE'])
+@bp.route('/products/<int:id>', methods=['DELETE'])
 def delete_product(id):
+    def write(conn):
+        # Kiểm tra xem sản phẩm có trong đơn hàng nào không
+        count = conn.execute('''
+            SELECT COUNT(*) as count FROM order_details WHERE product_id = ?
+        ''', (id,)).get
+        if count > 0:
+            raise ApiError("Cannot delete product used in orders", 400)
+
+        conn.execute('DELETE FROM products WHERE id = ?', (id,))
+        if conn.changes() == 0:
+            raise ApiError("Product not found", 404)
+
     try:
-        with connect_db() as conn:
-            # Kiểm tra xem sản phẩm có trong đơn hàng nào không
-            cursor = conn.execute('''
-                SELECT COUNT(*) as count FROM order_details WHERE product_id = ?
-            ''', (id,))
-            count = cursor.fetchone()['count']
-            if count > 0:
-                return jsonify({"error": "Cannot delete product used in orders"}), 400
-
-            cursor = conn.execute('DELETE FROM products WHERE id = ?', (id,))
-            if cursor.rowcount == 0:
-                return jsonify({"error": "Product not found"}), 404
+        run_write(write)
         return jsonify({"message": "Product deleted"})
+    except ApiError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
-        print("❌ Error in DELETE /products:", e)
+        logger.exception("Error in DELETE /products")
         return jsonify({"error": str(e)}), 500
 
 # --- GET all customers ---
-@app.route('/customers', methods=['GET'])
+@lru_cache(maxsize=2)
+def _customers_json(version):
+    cursor = g.conn.execute('SELECT id, name, phone FROM customers')
+    return rows_json(cursor)
+
+@bp.route('/customers', methods=['GET'])
+@with_reader
 def get_customers():
     try:
-        with connect_db() as conn:
-            cursor = conn.execute('SELECT * FROM customers')
-            rows = cursor.fetchall()
-            customers = [dict(row) for row in rows]
-        return jsonify(customers)
+        version = data_version(g.conn)
+        return versioned_response(version, lambda: _customers_json(version))
     except Exception as e:
-        print("❌ Error in GET /customers:", e)
+        logger.exception("Error in GET /customers")
         return jsonify({"error": str(e)}), 500
 
 # --- GET a specific customer ---
-@app.route('/customers/<int:id>', methods=['GET'])
+@bp.route('/customers/<int:id>', methods=['GET'])
+@with_reader
 def get_customer(id):
     try:
-        with connect_db() as conn:
-            cursor = conn.execute('SELECT * FROM customers WHERE id = ?', (id,))
-            customer = cursor.fetchone()
-            if customer is None:
-                return jsonify({"error": "Customer not found"}), 404
-        return jsonify(dict(customer))
+        conn = g.conn
+        cursor = conn.execute('SELECT id, name, phone FROM customers WHERE id = ?', (id,))
+        customer = row_dict(cursor)
+        if customer is None:
+            return jsonify({"error": "Customer not found"}), 404
+        return jsonify(customer)
     except Exception as e:
-        print("❌ Error in GET /customers/<id>:", e)
+        logger.exception("Error in GET /customers/<id>")
         return jsonify({"error": str(e)}), 500
 
 # --- POST create customer ---
-@app.route('/customers', methods=['POST'])
+@bp.route('/customers', methods=['POST'])
 def create_customer():
     try:
-        data = request.get_json()
-        if not data or 'name' not in data or 'phone' not in data:
-            return jsonify({"error": "Missing name or phone"}), 400
+        try:
+            req = customer_decoder.decode(request.get_data())
+        except msgspec.DecodeError as e:
+            return jsonify({"error": f"Invalid customer data: {e}"}), 400
+        
+        params = (req.name, req.phone)
         
-        with connect_db() as conn:
-            cursor = conn.execute('''
+        def write(conn):
+            conn.execute('''
                 INSERT INTO customers (name, phone)
                 VALUES (?, ?)
-            ''', (data['name'], data['phone']))
-            customer_id = cursor.lastrowid
+            ''', params)
+            return conn.last_insert_rowid()
+        
+        customer_id = run_write(write)
         
         return jsonify({"message": "Customer created", "id": customer_id}), 201
     except Exception as e:
-        print("❌ Error in POST /customers:", e)
+        logger.exception("Error in POST /customers")
         return jsonify({"error": str(e)}), 500
 
 # --- PUT update customer ---
-@app.route('/customers/<int:id>', methods=['PUT'])
+@bp.route('/customers/<int:id>', methods=['PUT'])
 def update_customer(id):
     try:
         data = request.get_json()
-        with connect_db() as conn:
-            cursor = conn.execute('''
+        params = (data['name'], data['phone'], id)
+        
+        def write(conn):
+            conn.execute('''
                 UPDATE customers
                 SET name = ?, phone = ?
                 WHERE id = ?
-            ''', (data['name'], data['phone'], id))
-            if cursor.rowcount == 0:
-                return jsonify({"error": "Customer not found"}), 404
+            ''', params)
+            return conn.changes()
+        
+        updated = run_write(write)
+        if updated == 0:
+            return jsonify({"error": "Customer not found"}), 404
         return jsonify({"message": "Customer updated"})
     except Exception as e:
-        print("❌ Error in PUT /customers/<id>:", e)
+        logger.exception("Error in PUT /customers/<id>")
         return jsonify({"error": str(e)}), 500
 
 # --- DELETE customer ---
-@app.route('/customers/<int:id>', methods=['DELETE'])
+@bp.route('/customers/<int:id>', methods=['DELETE'])
 def delete_customer(id):
+    def write(conn):
+        # Kiểm tra xem khách hàng có đơn hàng nào không
+        count = conn.execute('SELECT COUNT(*) as count FROM orders WHERE customer_id = ?', (id,)).get
+        if count > 0:
+            raise ApiError("Cannot delete customer with orders", 400)
+            
+        conn.execute('DELETE FROM customers WHERE id = ?', (id,))
+        if conn.changes() == 0:
+            raise ApiError("Customer not found", 404)
+
     try:
-        with connect_db() as conn:
-            # Kiểm tra xem khách hàng có đơn hàng nào không
-            cursor = conn.execute('SELECT COUNT(*) as count FROM orders WHERE customer_id = ?', (id,))
-            count = cursor.fetchone()['count']
-            if count > 0:
-                return jsonify({"error": "Cannot delete customer with orders"}), 400
-                
-            cursor = conn.execute('DELETE FROM customers WHERE id = ?', (id,))
-            if cursor.rowcount == 0:
-                return jsonify({"error": "Customer not found"}), 404
+        run_write(write)
         return jsonify({"message": "Customer deleted"})
+    except ApiError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
-        print("❌ Error in DELETE /customers/<id>:", e)
+        logger.exception("Error in DELETE /customers/<id>")
         return jsonify({"error": str(e)}), 500
 
 # --- GET all orders ---
-@app.route('/orders', methods=['GET'])
+@lru_cache(maxsize=2)
+def _orders_json(version):
+    cursor = g.conn.execute('''
+        SELECT o.id, o.customer_id, o.order_date, o.total, c.name AS customer_name, c.phone AS customer_phone
+        FROM orders o
+        JOIN customers c ON o.customer_id = c.id
+    ''')
+    return rows_json(cursor)
+
+@bp.route('/orders', methods=['GET'])
+@with_reader
 def get_orders():
     try:
-        with connect_db() as conn:
-            cursor = conn.execute('''
-                SELECT o.*, c.name AS customer_name, c.phone AS customer_phone
-                FROM orders o
-                JOIN customers c ON o.customer_id = c.id
-            ''')
-            rows = cursor.fetchall()
-            orders = [dict(row) for row in rows]
-        return jsonify(orders)
+        version = data_version(g.conn)
+        return versioned_response(version, lambda: _orders_json(version))
     except Exception as e:
-        print("❌ Error in GET /orders:", e)
+        logger.exception("Error in GET /orders")
         return jsonify({"error": str(e)}), 500
 
 # --- POST create order ---
-@app.route('/orders', methods=['POST'])
+@bp.route('/orders', methods=['POST'])
 def create_order():
-    try:
-        data = request.get_json()
-        print("Received order data:", data)  # Debug log
+    def write(conn):
+        # Kiểm tra khách hàng tồn tại (trên kết nối ghi, cùng giao dịch với lệnh INSERT,
+        # để khách hàng hay sản phẩm không thể bị xóa giữa lúc kiểm tra và lúc ghi)
+        if conn.execute(SQL_CUSTOMER_EXISTS, (req.customer_id,)).get is None:
+            raise ApiError(f"Customer ID {req.customer_id} not found", 404)
         
-        if not data or 'products' not in data:
-            return jsonify({"error": "Invalid order data"}), 400
+        # Kiểm tra sản phẩm tồn tại
+        missing_id = find_missing_product(conn, [line.product_id for line in req.products])
+        if missing_id is not None:
+            raise ApiError(f"Product ID {missing_id} not found", 404)
         
-        with connect_db() as conn:
-            # Enable foreign key constraints
-            conn.execute("PRAGMA foreign_keys = ON")
-            
-            # Kiểm tra khách hàng tồn tại
-            cursor = conn.execute('SELECT id FROM customers WHERE id = ?', (data['customer_id'],))
-            customer = cursor.fetchone()
-            if not customer:
-                return jsonify({"error": f"Customer ID {data['customer_id']} not found"}), 404
-            
-            # Tính toán tổng tiền từ các sản phẩm để đảm bảo chính xác
-            total = 0
-            for product in data['products']:
-                total += product['price'] * product['quantity']
-            
-            # Tạo đơn hàng mới với tổng tiền được tính lại
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            cursor = conn.execute('''
-                INSERT INTO orders (customer_id, order_date, total)
-                VALUES (?, ?, ?)
-            ''', (data['customer_id'], current_time, total))
-            order_id = cursor.lastrowid
-            
-            # Tạo chi tiết đơn hàng
-            for product in data['products']:
-                # Kiểm tra sản phẩm tồn tại
-                cursor = conn.execute('SELECT id FROM products WHERE id = ?', (product['product_id'],))
-                if not cursor.fetchone():
-                    return jsonify({"error": f"Product ID {product['product_id']} not found"}), 404
-                
-                conn.execute('''
-                    INSERT INTO order_details (order_id, product_id, quantity, price)
-                    VALUES (?, ?, ?, ?)
-                ''', (order_id, product['product_id'], product['quantity'], product['price']))
-            
+        # Đơn hàng được tạo với total = 0, trigger trg_od_ai tính lại khi thêm chi tiết
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        conn.execute(SQL_INSERT_ORDER, (req.customer_id, current_time))
+        order_id = conn.last_insert_rowid()
+        conn.executemany(SQL_INSERT_ORDER_DETAIL,
+                         [(order_id, line.product_id, line.quantity, line.price) for line in req.products])
+        
+        total = conn.execute('SELECT total FROM orders WHERE id = ?', (order_id,)).get
+        return order_id, total
+
+    try:
+        try:
+            req = order_decoder.decode(request.get_data())
+        except msgspec.DecodeError as e:
+            return jsonify({"error": f"Invalid order data: {e}"}), 400
+        
+        # Chờ COMMIT rồi mới trả lời, để client biết chắc đơn hàng đã được ghi
+        order_id, total = run_write(write)
         return jsonify({"message": "Order created", "order_id": order_id, "total": total}), 201
+    except ApiError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
-        print("❌ Error in POST /orders:", e)
+        logger.exception("Error in POST /orders")
         return jsonify({"error": str(e)}), 500
 
 # --- GET order details ---
-@app.route('/orders/<int:id>', methods=['GET'])
+@lru_cache(maxsize=1024)
+def _order_json(id, version):
+    # Lấy thông tin đơn hàng cùng chi tiết trong một câu truy vấn
+    cursor = g.conn.execute('''
+        SELECT o.id, o.order_date, o.total, c.id as customer_id, c.name as customer_name, c.phone as customer_phone,
+               od.id as detail_id, od.quantity, od.price, p.id as product_id, p.name as product_name,
+               p.image as product_image, p.description as product_description
+        FROM orders o
+        JOIN customers c ON o.customer_id = c.id
+        LEFT JOIN (order_details od JOIN products p ON od.product_id = p.id) ON od.order_id = o.id
+        WHERE o.id = ?
+        ORDER BY od.id
+    ''', (id,))
+    rows = cursor.fetchall()
+    
+    if not rows:
+        return None
+    
+    order_dict = dict(zip(('id', 'order_date', 'total', 'customer_id', 'customer_name', 'customer_phone'),
+                          rows[0][:6]))
+    
+    # Gom chi tiết đơn hàng từ các dòng kết quả (LEFT JOIN trả về NULL nếu không có chi tiết)
+    details = [{
+        'id': detail_id,
+        'quantity': quantity,
+        'price': price,
+        'product_id': product_id,
+        'product_name': product_name,
+        'product_image': product_image,
+        'product_description': product_description,
+    } for (detail_id, quantity, price, product_id, product_name, product_image, product_description)
+        in (row[6:] for row in rows) if detail_id is not None]
+    order_dict['details'] = details
+    
+    return orjson.dumps(order_dict)
+
+@bp.route('/orders/<int:id>', methods=['GET'])
+@with_reader
 def get_order(id):
     try:
-        with connect_db() as conn:
-            # Lấy thông tin đơn hàng
-            cursor = conn.execute('''
-                SELECT o.id, o.order_date, o.total, c.id as customer_id, c.name as customer_name, c.phone as customer_phone
-                FROM orders o
-                JOIN customers c ON o.customer_id = c.id
-                WHERE o.id = ?
-            ''', (id,))
-            order = cursor.fetchone()
-            
-            if not order:
-                return jsonify({"error": "Order not found"}), 404
-            
-            order_dict = dict(order)
-            
-            # Lấy chi tiết đơn hàng
-            cursor = conn.execute('''
-                SELECT od.id, od.quantity, od.price, p.id as product_id, p.name as product_name, 
-                       p.image as product_image, p.description as product_description
-                FROM order_details od
-                JOIN products p ON od.product_id = p.id
-                WHERE od.order_id = ?
-            ''', (id,))
-            
-            details = [dict(row) for row in cursor.fetchall()]
-            order_dict['details'] = details
-            
-            # Kiểm tra và sửa total nếu bằng 0
-            if order_dict['total'] == 0 and details:
-                calculated_total = sum(detail['price'] * detail['quantity'] for detail in details)
-                if calculated_total > 0:
-                    # Cập nhật tổng tiền trong database
-                    conn.execute('UPDATE orders SET total = ? WHERE id = ?', 
-                               (calculated_total, id))
-                    order_dict['total'] = calculated_total
-                    print(f"Fixed zero total for order {id}, new total: {calculated_total}")
-            
-        return jsonify(order_dict)
+        version = data_version(g.conn)
+        response = versioned_response(version, lambda: _order_json(id, version))
+        if response is None:
+            return jsonify({"error": "Order not found"}), 404
+        return response
     except Exception as e:
-        print("❌ Error in GET /orders/<id>:", e)
+        logger.exception("Error in GET /orders/<id>")
         return jsonify({"error": str(e)}), 500
 
 # --- PUT update order ---
-@app.route('/orders/<int:id>', methods=['PUT'])
+@bp.route('/orders/<int:id>', methods=['PUT'])
 def update_order(id):
-    try:
-        data = request.get_json()
-        with connect_db() as conn:
-            # Enable foreign key constraints
-            conn.execute("PRAGMA foreign_keys = ON")
-            
-            # Kiểm tra đơn hàng tồn tại
-            cursor = conn.execute('SELECT id FROM orders WHERE id = ?', (id,))
-            if cursor.fetchone() is None:
-                return jsonify({"error": "Order not found"}), 404
-            
-            # Kiểm tra khách hàng tồn tại
-            if 'customer_id' in data:
-                cursor = conn.execute('SELECT id FROM customers WHERE id = ?', (data['customer_id'],))
-                if cursor.fetchone() is None:
-                    return jsonify({"error": f"Customer ID {data['customer_id']} not found"}), 404
-                
-                # Cập nhật thông tin đơn hàng
-                conn.execute('''
-                    UPDATE orders
-                    SET customer_id = ?, total = ?
-                    WHERE id = ?
-                ''', (data['customer_id'], data['total'], id))
-            
-            # Nếu có update chi tiết đơn hàng
-            if 'products' in data:
-                # Xóa chi tiết cũ
-                conn.execute('DELETE FROM order_details WHERE order_id = ?', (id,))
-                
-                # Thêm chi tiết mới
-                for product in data['products']:
-                    # Kiểm tra sản phẩm tồn tại
-                    cursor = conn.execute('SELECT id FROM products WHERE id = ?', (product['product_id'],))
-                    if not cursor.fetchone():
-                        return jsonify({"error": f"Product ID {product['product_id']} not found"}), 404
-                    
-                    conn.execute('''
-                        INSERT INTO order_details (order_id, product_id, quantity, price)
-                        VALUES (?, ?, ?, ?)
-                    ''', (id, product['product_id'], product['quantity'], product['price']))
+    def write(conn):
+        # Kiểm tra đơn hàng tồn tại
+        if conn.execute(SQL_ORDER_EXISTS, (id,)).get is None:
+            raise ApiError("Order not found", 404)
+        
+        # Kiểm tra khách hàng tồn tại
+        if req.customer_id is not msgspec.UNSET:
+            if conn.execute(SQL_CUSTOMER_EXISTS, (req.customer_id,)).get is None:
+                raise ApiError(f"Customer ID {req.customer_id} not found", 404)
+        
+        # Kiểm tra sản phẩm tồn tại
+        if req.products is not msgspec.UNSET:
+            missing_id = find_missing_product(conn, [line.product_id for line in req.products])
+            if missing_id is not None:
+                raise ApiError(f"Product ID {missing_id} not found", 404)
+        
+        # Mọi kiểm tra đã xong, từ đây chỉ còn ghi dữ liệu trong cùng một giao dịch
+        if req.customer_id is not msgspec.UNSET:
+            # Cập nhật thông tin đơn hàng
+            conn.execute('UPDATE orders SET customer_id = ? WHERE id = ?', (req.customer_id, id))
+        
+        # Nếu có update chi tiết đơn hàng (total được trigger tính lại)
+        if req.products is not msgspec.UNSET:
+            # Xóa chi tiết cũ
+            conn.execute(SQL_DELETE_ORDER_DETAILS, (id,))
             
+            # Thêm chi tiết mới
+            conn.executemany(SQL_INSERT_ORDER_DETAIL,
+                             [(id, line.product_id, line.quantity, line.price) for line in req.products])
+
+    try:
+        try:
+            req = order_update_decoder.decode(request.get_data())
+        except msgspec.DecodeError as e:
+            return jsonify({"error": f"Invalid order data: {e}"}), 400
+        
+        run_write(write)
         return jsonify({"message": "Order updated"})
+    except ApiError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
-        print("❌ Error in PUT /orders/<id>:", e)
+        logger.exception("Error in PUT /orders/<id>")
         return jsonify({"error": str(e)}), 500
 
 # --- DELETE order ---
-@app.route('/orders/<int:id>', methods=['DELETE'])
+@bp.route('/orders/<int:id>', methods=['DELETE'])
 def delete_order(id):
+    def write(conn):
+        # Kiểm tra đơn hàng tồn tại
+        if conn.execute(SQL_ORDER_EXISTS, (id,)).get is None:
+            raise ApiError("Order not found", 404)
+        
+        # Xóa chi tiết đơn hàng
+        conn.execute(SQL_DELETE_ORDER_DETAILS, (id,))
+        
+        # Xóa đơn hàng
+        conn.execute('DELETE FROM orders WHERE id = ?', (id,))
+
     try:
-        with connect_db() as conn:
-            # Enable foreign key constraints
-            conn.execute("PRAGMA foreign_keys = ON")
-            
-            # Kiểm tra đơn hàng tồn tại
-            cursor = conn.execute('SELECT id FROM orders WHERE id = ?', (id,))
-            if cursor.fetchone() is None:
-                return jsonify({"error": "Order not found"}), 404
-            
-            # Xóa chi tiết đơn hàng
-            conn.execute('DELETE FROM order_details WHERE order_id = ?', (id,))
-            
-            # Xóa đơn hàng
-            conn.execute('DELETE FROM orders WHERE id = ?', (id,))
+        run_write(write)
         return jsonify({"message": "Order deleted"})
+    except ApiError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
-        print("❌ Error in DELETE /orders/<id>:", e)
+        logger.exception("Error in DELETE /orders/<id>")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/fix-orders-with-zero-total', methods=['GET'])
-def fix_orders_with_zero_total():
-    try:
-        with connect_db() as conn:
-            # Tìm tất cả các đơn hàng có total = 0
-            cursor = conn.execute('SELECT id FROM orders WHERE total = 0')
-            zero_total_orders = [row['id'] for row in cursor.fetchall()]
-            
-            updated_count = 0
-            for order_id in zero_total_orders:
-                # Tính tổng tiền dựa trên chi tiết đơn hàng
-                cursor = conn.execute('''
-                    SELECT SUM(quantity * price) as total 
-                    FROM order_details 
-                    WHERE order_id = ?
-                ''', (order_id,))
-                calculated_total = cursor.fetchone()['total'] or 0
-                
-                if calculated_total > 0:
-                    # Cập nhật tổng tiền
-                    conn.execute('UPDATE orders SET total = ? WHERE id = ?', 
-                               (calculated_total, order_id))
-                    updated_count += 1
-            
-            return jsonify({
-                "message": f"Fixed {updated_count} orders with zero total",
-                "orders_fixed": zero_total_orders
-            })
-    except Exception as e:
-        print("❌ Error fixing orders with zero total:", e)
-        return jsonify({"error": str(e)}), 500
+# --- App factory ---
+def create_app():
+    app = Flask(__name__)
+    CORS(app)
+    if not app.debug:
+        logger.setLevel(logging.WARNING)
+    
+    # init_db() chỉ dùng IF NOT EXISTS nên chạy mỗi lần khởi động để DB cũ cũng có đủ index
+    first_run = not os.path.exists(DB_NAME)
+    init_db()
+    if first_run:
+        print("Database created for the first time")
+    
+    app.register_blueprint(bp)
+    return app
 
 # --- Start server ---
 if __name__ == '__main__':
-    # Chỉ khởi tạo DB nếu chưa tồn tại
-    if not os.path.exists(DB_NAME):
-        init_db()
-        print("Database created at startup")
+    app = create_app()
     
     # Kiểm tra xem có sản phẩm nào trong DB chưa
     try:
-        with connect_db() as conn:
-            cursor = conn.execute('SELECT COUNT(*) FROM products')
-            count = cursor.fetchone()[0]
-            if count == 0:
-                print("No products found, you may want to call /init-sample-data")
+        with reader() as conn:
+            count = conn.execute('SELECT COUNT(*) FROM products').get
+        if count == 0:
+            print("No products found, you may want to call /init-sample-data")
     except Exception as e:
         print("Error checking products:", e)
     
-    app.run(host='0.0.0.0', port=1234, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=1234, debug=False)
@@ -0,0 +1,23 @@
+# Cấu hình gunicorn cho production: nhiều worker process, mỗi worker nhiều thread
+# Chạy: gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+worker_class = 'gthread'
+# Mỗi worker có một writer thread riêng, nên ít process hơn thì lô ghi lớn hơn
+# và ít tranh khoá ghi SQLite giữa các process.
+# Thread chờ DB / chờ writer gần như không tốn CPU (apsw nhả GIL khi gọi SQLite),
+# nên tăng số thread thay vì số process
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+# Import app (và chạy init_db) một lần ở master trước khi fork.
+# Connection pool và writer thread được tạo lười ở lần dùng đầu tiên trong từng worker,
+# nên không có kết nối SQLite hay thread nào bị chia sẻ qua fork
+preload_app = True
+
+def post_fork(server, worker):
+    # Mỗi thread của worker có một kết nối đọc riêng, kể cả khi số thread đặt bằng --threads
+    import app
+    app.READER_POOL_SIZE = server.cfg.threads